@@ -28,6 +28,7 @@
 #include <sys/stat.h>
 #include <sys/types.h>
 #include <termios.h>
+#include <time.h>
 #include <unistd.h>
 
 static espstlink_error_t error = {0, NULL};
@@ -99,12 +100,16 @@ espstlink_t *espstlink_open(const char *device) {
   espstlink_t *pgm = malloc(sizeof(espstlink_t));
   pgm->version = -1;
   pgm->fd = fd;
+  pgm->baud = 921600;
+  pgm->rx_len = 0;
   
   if (!espstlink_fetch_version(pgm)) {
     // older versions used slower serial speed. try again with that one.
     cfsetospeed(&tty, (speed_t)B115200);
     cfsetispeed(&tty, (speed_t)B115200);
     tcflush(fd, TCIFLUSH);
+    pgm->baud = 115200;
+    pgm->rx_len = 0;
     if (tcsetattr(fd, TCSANOW, &tty) != 0) {
       set_error(ESPSTLINK_ERROR_SERIAL, "Setting tty attributes failed on '%s'", dev);
       perror(NULL);
@@ -158,6 +163,42 @@ static const char *swim_error_name(int code) {
   }
 }
 
+/** Fixed allowance for the device to start processing a command. */
+#define BASE_TIMEOUT_MS 10
+/** Upper bound for transferring one byte over SWIM, including the ack. */
+#define SWIM_BYTE_US 50
+/**
+ * The firmware's SWIM entry sequence takes 16us + 8x500us + 8x250us (about
+ * 6ms) before it replies.
+ */
+#define SWIM_ENTRY_MS 8
+/**
+ * Extra time granted once the device started responding. After the ack the
+ * firmware retransmits NACKed SWIM bytes without limit, so there is no real
+ * worst case: the previous reader blocked indefinitely at this point (note
+ * that cfmakeraw() in espstlink_open resets VMIN/VTIME to 1/0). This is a
+ * hard limit instead, far beyond what a responsive target needs.
+ */
+#define PROGRESS_ALLOWANCE_MS 1000
+
+/**
+ * Returns how long to wait for the response to a command: the fixed
+ * allowance, the time request and response take on the wire (8N1, i.e. 10
+ * bits per byte) and the time spent transferring `swim_bytes` over SWIM.
+ */
+static int response_timeout_ms(espstlink_t *pgm, size_t tx_len,
+                               size_t rx_len, size_t swim_bytes) {
+  int wire_ms = ((tx_len + rx_len) * 10 * 1000 + pgm->baud - 1) / pgm->baud;
+  int swim_ms = (swim_bytes * SWIM_BYTE_US + 999) / 1000;
+  return BASE_TIMEOUT_MS + wire_ms + swim_ms;
+}
+
+static int64_t now_ms() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (int64_t)ts.tv_sec * 1000 + ts.tv_nsec / 1000000;
+}
+
 static bool is_data_available(int fd, int timeout_ms) {
   fd_set set;
   struct timeval timeout;
@@ -167,84 +208,130 @@ static bool is_data_available(int fd, int timeout_ms) {
   FD_SET (fd, &set);
 
   /* Initialize the timeout data structure. */
-  timeout.tv_sec = 0;
-  timeout.tv_usec = timeout_ms * 1000;
+  timeout.tv_sec = timeout_ms / 1000;
+  timeout.tv_usec = (timeout_ms % 1000) * 1000;
   
-  return select(FD_SETSIZE, &set, NULL, NULL, &timeout) != 0;
+  return select(fd + 1, &set, NULL, NULL, &timeout) > 0;
 }  
 
-static bool error_check(int fd, uint8_t command, uint8_t *resp_buf,
-                        size_t size) {
-  uint8_t buf[4];
+/** Drops `len` bytes from the front of the receive buffer. */
+static void consume(espstlink_t *pgm, size_t len) {
+  pgm->rx_len -= len;
+  memmove(pgm->rx_buf, pgm->rx_buf + len, pgm->rx_len);
+}
 
-  if (!is_data_available(fd, /*timeout_ms=*/ 10)) {
-    set_error(ESPSTLINK_ERROR_READ,
-              "Device didn't respond to command: %s", command_name(command));
-    if (command == 0xFF) { // GET_VERSION
-      fprintf(stderr, "(this may be ok if the device is running espstlink prior to v0.2)\n");
+/**
+ * Moves the unparseable receive buffer into the error data and drops
+ * whatever else the tty has received, so that the remains of this response
+ * aren't taken for the next one.
+ */
+static void discard_into_error(espstlink_t *pgm) {
+  error.data_len = MIN(pgm->rx_len, sizeof(error.data));
+  memcpy(error.data, pgm->rx_buf, error.data_len);
+  pgm->rx_len = 0;
+  tcflush(pgm->fd, TCIFLUSH);
+}
+
+/**
+ * Waits for the response to `command` and copies its `size` payload bytes
+ * into resp_buf.
+ *
+ * Each read() takes whatever the device has sent so far into the receive
+ * buffer. Bytes beyond the end of this response are kept for the next one.
+ * The deadline is restarted with PROGRESS_ALLOWANCE_MS on top whenever more
+ * bytes arrive.
+ */
+static bool error_check(espstlink_t *pgm, uint8_t command, uint8_t *resp_buf,
+                        size_t size, int timeout_ms) {
+  int64_t deadline = now_ms() + timeout_ms;
+  uint8_t *buf = pgm->rx_buf;
+
+  while (1) {
+    if (pgm->rx_len >= 1 && buf[0] != command) {
+      set_error(ESPSTLINK_ERROR_DATA, "Unexpected data: %02x\n", buf[0]);
+      discard_into_error(pgm);
+      return 0;
+    }
+    if (pgm->rx_len >= 2) {
+      if (buf[1] == 0 && pgm->rx_len >= 2 + size) {
+        if (resp_buf && size) memcpy(resp_buf, buf + 2, size);
+        consume(pgm, 2 + size);
+        return 1;
+      }
+      if (buf[1] == 0xFF && pgm->rx_len >= 4) {
+        int code = buf[2] << 8 | buf[3];
+        set_error(ESPSTLINK_ERROR_COMM,
+                  "Command 0x%02x (%s) failed with code: 0x%02x (%s)\n", buf[0],
+                  command_name(buf[0]), code, swim_error_name(code));
+        error.device_code = code;
+        consume(pgm, 4);
+        return 0;
+      }
+      if (buf[1] != 0 && buf[1] != 0xFF) {
+        set_error(ESPSTLINK_ERROR_DATA,
+                  "Unexpected error code for command 0x%02x (%s): 0x%02x\n",
+                  buf[0], command_name(buf[0]), buf[1]);
+        discard_into_error(pgm);
+        return 0;
+      }
     }
-    return 0;
-  }
 
-  int len = read(fd, buf, 1);
-  if (len < 1) {
-    set_error(ESPSTLINK_ERROR_READ,
-              "Didn't get a response from the device: %s\n", strerror(errno));
-    return 0;
-  }
-  if (buf[0] != command) {
-    set_error(ESPSTLINK_ERROR_DATA, "Unexpected data: %02x\n", buf[0]);
-    error.data[0] = buf[0];
-    error.data_len = 1 + read(fd, &error.data[1], sizeof(error.data) - 1);
-    return 0;
-  }
-  len = read(fd, buf + 1, 1);
-  if (len < 1) {
-    set_error(ESPSTLINK_ERROR_DATA,
-              "Device didn't finish command 0x%02x (%s): %s\n", buf[0],
-              command_name(buf[0]), strerror(errno));
-    return 0;
-  }
-  if (buf[1] == 0) {
-    if (resp_buf && size) {
-      size_t total = 0;
-      while (total < size) {
-        len = read(fd, resp_buf + total, size);
-        if (len < 1) {
-          set_error(
-              ESPSTLINK_ERROR_DATA,
-              "Incomplete response for command 0x%02x (%s): expected %d bytes, "
-              "but got %d bytes (%s)\n",
-              buf[0], command_name(buf[0]), size, len, strerror(errno));
-          return 0;
+    int64_t remaining = deadline - now_ms();
+    if (remaining <= 0 || !is_data_available(pgm->fd, remaining)) {
+      if (pgm->rx_len == 0) {
+        set_error(ESPSTLINK_ERROR_READ,
+                  "Device didn't respond to command: %s", command_name(command));
+        if (command == 0xFF) { // GET_VERSION
+          fprintf(stderr, "(this may be ok if the device is running espstlink prior to v0.2)\n");
         }
-        total += len;
+      } else if (pgm->rx_len == 1) {
+        set_error(ESPSTLINK_ERROR_DATA,
+                  "Device didn't finish command 0x%02x (%s)\n", command,
+                  command_name(command));
+      } else {
+        set_error(
+            ESPSTLINK_ERROR_DATA,
+            "Incomplete response for command 0x%02x (%s): expected %zu bytes, "
+            "but got %zu bytes\n",
+            command, command_name(command),
+            buf[1] == 0 ? 2 + size : (size_t)4, pgm->rx_len);
       }
+      discard_into_error(pgm);
+      return 0;
     }
-    return 1;
-  }
-  if (buf[1] == 0xFF) {
-    len = read(fd, buf + 2, 2);
-    if (len < 2) {
-      set_error(ESPSTLINK_ERROR_DATA,
-                "Device didn't finish sending error code for command 0x%02x "
-                "(%s): %s\n",
-                buf[0], command_name(buf[0]), strerror(errno));
+
+    int len = read(pgm->fd, buf + pgm->rx_len, sizeof(pgm->rx_buf) - pgm->rx_len);
+    if (len == 0) {
+      set_error(ESPSTLINK_ERROR_READ,
+                "Didn't get a response from the device: connection closed (EOF)\n");
+      discard_into_error(pgm);
+      return 0;
+    }
+    if (len < 0) {
+      set_error(ESPSTLINK_ERROR_READ,
+                "Didn't get a response from the device: %s\n", strerror(errno));
+      discard_into_error(pgm);
       return 0;
     }
-    int code = buf[2] << 8 | buf[3];
-    set_error(ESPSTLINK_ERROR_COMM,
-              "Command 0x%02x (%s) failed with code: 0x%02x (%s)\n", buf[0],
-              command_name(buf[0]), code, swim_error_name(code));
-    error.device_code = code;
-  } else {
-    set_error(ESPSTLINK_ERROR_DATA,
-              "Unexpected error code for command 0x%02x (%s): 0x%02x\n", buf[0],
-              command_name(buf[0]), buf[1]);
-    error.data[0] = buf[0];
-    error.data[1] = buf[1];
-    error.data_len = 2 + read(fd, &error.data[2], sizeof(error.data) - 2);
+    pgm->rx_len += len;
+    deadline = now_ms() + timeout_ms + PROGRESS_ALLOWANCE_MS;
   }
+}
+
+/**
+ * READ and WRITE responses echo count and address. A mismatch means a late
+ * response to an earlier (timed out) command was received.
+ */
+static bool check_echo(espstlink_t *pgm, const uint8_t *cmd,
+                       const uint8_t *resp_buf) {
+  if (memcmp(cmd + 1, resp_buf, 4) == 0) return 1;
+  set_error(ESPSTLINK_ERROR_DATA,
+            "Response for command 0x%02x (%s) doesn't match the request\n",
+            cmd[0], command_name(cmd[0]));
+  pgm->rx_len = 0;
+  tcflush(pgm->fd, TCIFLUSH);
+  memcpy(error.data, resp_buf, 4);
+  error.data_len = 4;
   return 0;
 }
 
@@ -256,7 +343,9 @@ bool espstlink_fetch_version(espstlink_t *pgm) {
   uint8_t resp_buf[2];
 
   write(pgm->fd, cmd, 1);
-  if (!error_check(pgm->fd, cmd[0], resp_buf, 2)) return 0;
+  if (!error_check(pgm, cmd[0], resp_buf, 2,
+                   response_timeout_ms(pgm, 1, 4, 0)))
+    return 0;
 
   int version = resp_buf[0] << 8 | resp_buf[1];
   if (version > 2) {
@@ -269,12 +358,14 @@ bool espstlink_fetch_version(espstlink_t *pgm) {
   return 1;
 }
 
-bool espstlink_swim_entry(const espstlink_t *pgm) {
+bool espstlink_swim_entry(espstlink_t *pgm) {
   uint8_t cmd[] = {0xFE};
   uint8_t resp_buf[2];
 
   write(pgm->fd, cmd, 1);
-  if (!error_check(pgm->fd, cmd[0], resp_buf, 2)) return 0;
+  if (!error_check(pgm, cmd[0], resp_buf, 2,
+                   response_timeout_ms(pgm, 1, 4, 0) + SWIM_ENTRY_MS))
+    return 0;
 
   int duration = resp_buf[0] << 8 | resp_buf[1];
   if (duration < 1200 || duration > 1360) {
@@ -285,39 +376,45 @@ bool espstlink_swim_entry(const espstlink_t *pgm) {
   return 1;
 }
 
-bool espstlink_reset(const espstlink_t *pgm, bool input, bool enable_reset) {
+bool espstlink_reset(espstlink_t *pgm, bool input, bool enable_reset) {
   uint8_t cmd[] = {0xFD, input ? 0xFF : enable_reset};
 
   write(pgm->fd, cmd, 2);
-  return error_check(pgm->fd, cmd[0], NULL, 0);
+  return error_check(pgm, cmd[0], NULL, 0, response_timeout_ms(pgm, 2, 2, 0));
 }
 
-bool espstlink_swim_srst(const espstlink_t *pgm) {
+bool espstlink_swim_srst(espstlink_t *pgm) {
   uint8_t cmd[] = {0};
 
   write(pgm->fd, cmd, 1);
-  return error_check(pgm->fd, cmd[0], NULL, 0);
+  return error_check(pgm, cmd[0], NULL, 0, response_timeout_ms(pgm, 1, 2, 1));
 }
 
-bool espstlink_swim_read(const espstlink_t *pgm, uint8_t *buffer,
+bool espstlink_swim_read(espstlink_t *pgm, uint8_t *buffer,
                          unsigned int addr, size_t size) {
   uint8_t cmd[] = {1, size, addr >> 16, addr >> 8, addr};
   uint8_t resp_buf[512];
   write(pgm->fd, cmd, 5);
-  if (!error_check(pgm->fd, cmd[0], resp_buf, cmd[1] + 4)) return 0;
+  if (!error_check(pgm, cmd[0], resp_buf, cmd[1] + 4,
+                   response_timeout_ms(pgm, 5, 6 + size, 5 + size)))
+    return 0;
+  if (!check_echo(pgm, cmd, resp_buf)) return 0;
   // there's 4 non data bytes in the response: len, 3*address
   memcpy(buffer, resp_buf + 4, size);
   return 1;
 }
 
-bool espstlink_swim_write(const espstlink_t *pgm, const uint8_t *buffer,
+bool espstlink_swim_write(espstlink_t *pgm, const uint8_t *buffer,
                           unsigned int addr, size_t size) {
   uint8_t cmd[] = {2, size, addr >> 16, addr >> 8, addr};
   write(pgm->fd, cmd, 5);
   write(pgm->fd, buffer, cmd[1]);
 
   uint8_t resp_buf[4];
-  return error_check(pgm->fd, cmd[0], resp_buf, 4);
+  if (!error_check(pgm, cmd[0], resp_buf, 4,
+                   response_timeout_ms(pgm, 5 + size, 6, 5 + size)))
+    return 0;
+  return check_echo(pgm, cmd, resp_buf);
 }
 
 void espstlink_close(espstlink_t *pgm) {
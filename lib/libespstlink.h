@@ -9,9 +9,17 @@
 #include <stddef.h>
 #include <stdint.h>
 
+/** Large enough for the longest response (READ of 255 bytes). */
+#define ESPSTLINK_RX_BUFFER_SIZE 512
+
 typedef struct _espstlink_t {
   int fd;
   int version;
+  /** Baud rate of the serial connection, used to derive response timeouts. */
+  int baud;
+  /** Received bytes that have not been consumed by a response yet. */
+  uint8_t rx_buf[ESPSTLINK_RX_BUFFER_SIZE];
+  size_t rx_len;
 } espstlink_t;
 
 typedef struct _esplink_error_t {
@@ -41,11 +49,11 @@ espstlink_t *espstlink_open(const char *device);
 void espstlink_close(espstlink_t *pgm);
 bool espstlink_fetch_version(espstlink_t *pgm);
 
-bool espstlink_swim_entry(const espstlink_t *pgm);
-bool espstlink_swim_srst(const espstlink_t *pgm);
-bool espstlink_swim_read(const espstlink_t *pgm, uint8_t *buffer,
+bool espstlink_swim_entry(espstlink_t *pgm);
+bool espstlink_swim_srst(espstlink_t *pgm);
+bool espstlink_swim_read(espstlink_t *pgm, uint8_t *buffer,
                          unsigned int addr, size_t size);
-bool espstlink_swim_write(const espstlink_t *pgm, const uint8_t *buffer,
+bool espstlink_swim_write(espstlink_t *pgm, const uint8_t *buffer,
                           unsigned int addr, size_t size);
 
 /**
@@ -55,5 +63,5 @@ bool espstlink_swim_write(const espstlink_t *pgm, const uint8_t *buffer,
  * value == 0: DEFAULT, sets the pin HIGH
  * value == 1: RESET, sets the pin LOW
  */
-bool espstlink_reset(const espstlink_t *pgm, bool input, bool enable_reset);
+bool espstlink_reset(espstlink_t *pgm, bool input, bool enable_reset);
 #endif
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Records or replays the STLink traffic of another tool.
+
+  ./capture.py record flash.cap ./flash.py -i firmware.ihx
+  ./capture.py replay [--realtime] flash.cap ./flash.py -i firmware.ihx
+  ./capture.py diff before.cap after.cap
+"""
+import os
+import runpy
+import sys
+import time
+import warnings
+
+import espstlink
+from espstlink import capture
+
+def run_tool(stlink_class, tool_argv, **kwargs):
+  """Runs the tool script with espstlink.STLink replaced by stlink_class."""
+  class BoundSTLink(stlink_class):
+    def __init__(self, tty: bytes=b"/dev/ttyUSB0"):
+      super().__init__(tty, **kwargs)
+      instances.append(self)
+  instances = []
+  espstlink.STLink = BoundSTLink
+  sys.argv = tool_argv
+  sys.path.insert(0, os.path.dirname(os.path.abspath(tool_argv[0])))
+  runpy.run_path(tool_argv[0], run_name='__main__')
+  return instances
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser()
+  sub = parser.add_subparsers(dest='mode', required=True)
+  record = sub.add_parser('record', help="Run a tool and record its traffic")
+  record.add_argument('capture')
+  record.add_argument('tool', nargs=argparse.REMAINDER)
+  replay = sub.add_parser('replay', help="Run a tool against a recorded capture")
+  replay.add_argument("-r", "--realtime", action='store_true',
+                      help="Reproduce the recorded timing instead of replaying as fast as possible")
+  replay.add_argument('capture')
+  replay.add_argument('tool', nargs=argparse.REMAINDER)
+  diff = sub.add_parser('diff', help="Compare command counts and round-trip times of two captures")
+  diff.add_argument('a')
+  diff.add_argument('b')
+  args = parser.parse_args()
+  warnings.formatwarning = lambda message, *args, **kwargs: 'WARNING: %s\n' % message
+
+  if args.mode == 'record':
+    writer = capture.CaptureWriter(args.capture)
+    try:
+      run_tool(capture.RecordingSTLink, args.tool, capture=writer)
+    finally:
+      writer.close()
+  elif args.mode == 'replay':
+    start = time.perf_counter()
+    instances = []
+    try:
+      instances = run_tool(capture.ReplaySTLink, args.tool,
+                           capture=args.capture, realtime=args.realtime)
+    except capture.ReplayDivergence as e:
+      sys.exit('DIVERGENCE: %s' % e)
+    finally:
+      print('Replayed in %.3fs' % (time.perf_counter() - start), file=sys.stderr)
+    for dev in instances:
+      if dev.remaining():
+        sys.exit('DIVERGENCE: %d recorded commands were not issued' % dev.remaining())
+  else:
+    print(capture.compare(list(capture.load(args.a)), list(capture.load(args.b))))
@@ -2,31 +2,6 @@ from ctypes import *
 import time
 import os
 
-stlink = None
-
-for location in [
-  os.path.join(os.path.dirname(__file__), "..", "..", "lib", "libespstlink.so"),
-  os.path.join(os.path.dirname(__file__), "libespstlink.so"),
-  "libespstlink.so"]:
-  try:
-    stlink = cdll.LoadLibrary(location)
-  except:
-    pass
-
-if stlink is None:
-  raise RuntimeError("libespstlink.so could not be found. Was it compiled in espstlink_base/lib/?")
-
-stlink.espstlink_open.argtypes = [c_char_p]
-stlink.espstlink_open.restype = c_void_p
-
-stlink.espstlink_swim_entry.argtypes = [c_void_p]
-stlink.espstlink_swim_srst.argtypes = [c_void_p]
-stlink.espstlink_reset.argtypes = [c_void_p, c_bool, c_bool]
-stlink.espstlink_close.argtypes = [c_void_p]
-stlink.espstlink_swim_read.argtypes = [c_void_p, c_char_p, c_uint, c_uint]
-stlink.espstlink_swim_write.argtypes = [c_void_p, c_char_p, c_uint, c_uint]
-stlink.espstlink_fetch_version.argtypes = [c_void_p]
-
 class _STLinkError(Structure):
     _fields_ = [("code", c_int),
                 ("message", c_char_p),
@@ -34,7 +9,46 @@ class _STLinkError(Structure):
                 ("data_len", c_size_t),
                 ("device_code", c_int)]
 
-stlink.espstlink_get_last_error.restype = POINTER(_STLinkError)
+stlink = None
+
+def load_library():
+  """
+  Loads libespstlink.so on first use.
+
+  Only STLink needs it, the rest of the package (e.g. espstlink.aio) works
+  without the library being built.
+  """
+  global stlink
+  if stlink is not None:
+    return stlink
+
+  lib = None
+  for location in [
+    os.path.join(os.path.dirname(__file__), "..", "..", "lib", "libespstlink.so"),
+    os.path.join(os.path.dirname(__file__), "libespstlink.so"),
+    "libespstlink.so"]:
+    try:
+      lib = cdll.LoadLibrary(location)
+    except:
+      pass
+
+  if lib is None:
+    raise RuntimeError("libespstlink.so could not be found. Was it compiled in espstlink_base/lib/?")
+
+  lib.espstlink_open.argtypes = [c_char_p]
+  lib.espstlink_open.restype = c_void_p
+
+  lib.espstlink_swim_entry.argtypes = [c_void_p]
+  lib.espstlink_swim_srst.argtypes = [c_void_p]
+  lib.espstlink_reset.argtypes = [c_void_p, c_bool, c_bool]
+  lib.espstlink_close.argtypes = [c_void_p]
+  lib.espstlink_swim_read.argtypes = [c_void_p, c_char_p, c_uint, c_uint]
+  lib.espstlink_swim_write.argtypes = [c_void_p, c_char_p, c_uint, c_uint]
+  lib.espstlink_fetch_version.argtypes = [c_void_p]
+  lib.espstlink_get_last_error.restype = POINTER(_STLinkError)
+  stlink = lib
+  return lib
+
 
 class STLinkException(Exception):
   def __init__(self):
@@ -46,7 +60,10 @@ class STLinkException(Exception):
       code = self.code, message=error.message, data=self.data))
 
 class STLink(object):
+  pgm = None
+
   def __init__(self, tty: bytes=b"/dev/ttyUSB0"):
+    load_library()
     self.pgm = stlink.espstlink_open(tty)
     if not self.pgm:
         raise STLinkException()
@@ -0,0 +1,454 @@
+"""
+asyncio bindings for the esp-stlink serial protocol.
+
+Unlike `espstlink.STLink`, which blocks inside libespstlink for every command,
+`AsyncSTLink` frames the protocol from `serial-protocol.md` itself on a
+non-blocking tty that is registered with the event loop. Commands are
+pipelined: several requests may be in flight and responses are matched to
+them in the order they were sent, so a single process can drive many
+adapters concurrently without threads.
+"""
+import asyncio
+import collections
+import os
+import termios
+import tty as _tty
+
+from .flash import Flash
+from .debugger import BREAKPOINT_MODES, Debugger
+from .protocol import *
+
+# The ESP8266 UART has a 128 byte receive FIFO. Keeping the number of
+# unacknowledged request bytes below that avoids overrunning the device
+# while it is busy talking SWIM. The device acks a command once it has taken
+# it out of the FIFO, so its bytes are released on the ack.
+MAX_IN_FLIGHT_BYTES = 128
+# Largest write that still allows two requests (5 byte header + data) to be
+# in flight at once.
+WRITE_CHUNK = (MAX_IN_FLIGHT_BYTES // 2) - 5
+
+class AsyncSTLinkError(Exception):
+  """Mirrors the fields of `espstlink.STLinkException`."""
+  def __init__(self, code: int, message: str, data: bytes=b'', device_code: int=0):
+    self.code = code
+    self.data = bytearray(data)
+    self.device_code = device_code
+    super().__init__('Device Error ({code}): {message} (data={data})'.format(
+      code=code, message=message, data=self.data))
+
+class _Request(object):
+  def __init__(self, command: int, payload: bytes, response_len: int, future):
+    self.command = command
+    self.payload = payload
+    self.response_len = response_len
+    self.future = future
+    self.acked = False
+
+class AsyncSTLink(object):
+  """
+  An esp-stlink adapter driven from an asyncio event loop.
+
+  Use `await AsyncSTLink.open(tty)` to create an instance.
+  """
+  def __init__(self, fd: int, loop=None, timeout: float=1.0):
+    self.fd = fd
+    self.loop = loop or asyncio.get_running_loop()
+    self.timeout = timeout
+    self.version = None
+    self._rx = bytearray()
+    self._tx = bytearray()
+    self._pending = collections.deque()
+    self._in_flight = 0
+    self._window_waiters = collections.deque()
+    self._writing = False
+    self._error = None
+    self.loop.add_reader(self.fd, self._on_readable)
+
+  @classmethod
+  async def open(cls, tty: str="/dev/ttyUSB0", timeout: float=1.0):
+    """Opens the serial device and checks the firmware version."""
+    try:
+      fd = os.open(tty, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError as e:
+      raise AsyncSTLinkError(ERROR_SERIAL, "Couldn't open tty '%s': %s" % (tty, e))
+    link = None
+    try:
+      for speed in (termios.B921600, termios.B115200):
+        _configure_tty(fd, speed)
+        link = cls(fd, timeout=timeout)
+        try:
+          await link.fetch_version()
+          return link
+        except AsyncSTLinkError as e:
+          # older versions used slower serial speed. try again with that one.
+          link._disconnect(e)
+          if e.code == ERROR_VERSION: raise
+          error = e
+      raise error
+    except BaseException:
+      if link is not None:
+        link.close()
+      else:
+        os.close(fd)
+      raise
+
+  def close(self):
+    if self.fd is None: return
+    self._disconnect(AsyncSTLinkError(ERROR_SERIAL, 'Connection closed'))
+    os.close(self.fd)
+    self.fd = None
+
+  def _disconnect(self, exception: Exception):
+    """Stops watching the tty and fails all current and future requests."""
+    if self._error is None:
+      self.loop.remove_reader(self.fd)
+      if self._writing:
+        self.loop.remove_writer(self.fd)
+        self._writing = False
+      self._error = exception
+    self._fail_all(exception)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc):
+    self.close()
+
+  async def command(self, command: int, payload: bytes=b'', response_len: int=0) -> bytearray:
+    """
+    Sends a raw command and waits for its response.
+
+    `response_len` is the number of bytes following the success indicator.
+    Returns these bytes.
+    """
+    if self._error is not None:
+      raise self._error
+    data = bytes([command]) + bytes(payload)
+    while self._in_flight and self._in_flight + len(data) > MAX_IN_FLIGHT_BYTES:
+      waiter = self.loop.create_future()
+      self._window_waiters.append(waiter)
+      await waiter
+      if self._error is not None:
+        raise self._error
+    self._in_flight += len(data)
+    request = _Request(command, data, response_len, self.loop.create_future())
+    self._pending.append(request)
+    self._send(data)
+    try:
+      return await asyncio.wait_for(asyncio.shield(request.future), self.timeout)
+    except asyncio.TimeoutError:
+      # The stream is out of sync now: a late response could be taken for
+      # the response of a later command, so the link can't be used anymore.
+      self._disconnect(AsyncSTLinkError(
+        ERROR_READ, "Device didn't respond to command: %s" % _name(command)))
+      return await request.future
+
+  async def fetch_version(self) -> int:
+    if self.version is None:
+      resp = await self.command(CMD_GET_VERSION, response_len=2)
+      version = resp[0] << 8 | resp[1]
+      if version > 2:
+        raise AsyncSTLinkError(ERROR_VERSION, 'Unsupported target version: %d.' % version,
+                               device_code=version)
+      self.version = version
+    return self.version
+
+  async def init(self, swim_entry=True, reset=True):
+    """
+    Starts a swim session.
+
+    If reset=True the chip will be put into reset for this.
+    """
+    if reset:
+      await self.reset(1)
+    if swim_entry:
+      await self.swim_entry()
+    await self.write(0x7f80, 0xA0)
+    if reset:
+      await self.reset(0)
+    await asyncio.sleep(0.001)
+
+  async def swim_entry(self) -> int:
+    """Starts a swim session (without reset). Returns the sync duration in cycles."""
+    resp = await self.command(CMD_SWIM_ENTRY, response_len=2)
+    return resp[0] << 8 | resp[1]
+
+  async def reset(self, value, input=False):
+    """
+    Performs a hardware reset of the STM8 device.
+
+    If input is True, the reset line will be configured as input.
+    """
+    await self.command(CMD_RESET, bytes([0xFF if input else int(bool(value))]))
+
+  async def soft_reset(self):
+    """Performs a software reset of the STM8 device."""
+    await self.command(CMD_SOFT_RESET)
+
+  async def read(self, address: int) -> int:
+    """Reads one byte at address"""
+    return (await self.read_bytes(address, 1))[0]
+
+  async def read_bytes(self, address: int, length: int) -> bytearray:
+    """Reads up to 255 bytes starting from address."""
+    assert length < 255
+    resp = await self.command(CMD_READ, _header(address, length), 4 + length)
+    # there's 4 non data bytes in the response: len, 3*address
+    return resp[4:]
+
+  async def read_w(self, address: int, size: int) -> int:
+    """Reads a multibyte integer starting from address."""
+    value = 0
+    for i in await self.read_bytes(address, size):
+      value = value << 8 | i
+    return value
+
+  async def write_bytes(self, address: int, buf: bytes) -> bool:
+    """Writes up to 255 bytes starting from address."""
+    assert len(buf) < 255
+    await self.command(CMD_WRITE, _header(address, len(buf)) + bytes(buf), 4)
+    return True
+
+  async def write(self, address: int, value: int) -> bool:
+    """Writes a single byte to address."""
+    return await self.write_bytes(address, bytearray([value]))
+
+  async def write_w(self, address: int, size: int, value: int) -> bool:
+    """Writes a little-endian multibyte integer to address."""
+    out = bytearray(size)
+    for i in reversed(range(size)):
+      out[i] = value & 0xff
+      value >>= 8
+    return await self.write_bytes(address, out)
+
+  async def read_range(self, address: int, length: int, chunk: int=0x80) -> bytearray:
+    """Reads an arbitrarily long range, pipelining the individual reads."""
+    parts = await asyncio.gather(*[
+      self.read_bytes(address + offset, min(chunk, length - offset))
+      for offset in range(0, length, chunk)])
+    return bytearray(b''.join(parts))
+
+  async def write_range(self, address: int, data: bytes, chunk: int=WRITE_CHUNK) -> bool:
+    """
+    Writes an arbitrarily long range, pipelining the individual writes.
+
+    With chunks larger than WRITE_CHUNK only one write fits into the device's
+    receive FIFO at a time, so the next one is only sent after the previous
+    one was acked.
+    """
+    await asyncio.gather(*[
+      self.write_bytes(address + offset, data[offset:offset + chunk])
+      for offset in range(0, len(data), chunk)])
+    return True
+
+  def _send(self, data: bytes):
+    self._tx += data
+    if not self._writing:
+      self._on_writable()
+
+  def _on_writable(self):
+    try:
+      written = os.write(self.fd, self._tx)
+    except BlockingIOError:
+      written = 0
+    except OSError as e:
+      self._fail_all(AsyncSTLinkError(ERROR_SERIAL, 'Write failed: %s' % e))
+      return
+    del self._tx[:written]
+    if self._tx and not self._writing:
+      self.loop.add_writer(self.fd, self._on_writable)
+      self._writing = True
+    elif not self._tx and self._writing:
+      self.loop.remove_writer(self.fd)
+      self._writing = False
+
+  def _on_readable(self):
+    try:
+      data = os.read(self.fd, 4096)
+    except BlockingIOError:
+      return
+    except OSError as e:
+      self._disconnect(AsyncSTLinkError(ERROR_READ,
+        "Didn't get a response from the device: %s" % e))
+      return
+    if not data:
+      self._disconnect(AsyncSTLinkError(ERROR_READ, 'Device disconnected (EOF)'))
+      return
+    self._rx += data
+    while self._pending and self._parse(self._pending[0]):
+      self._pending.popleft()
+
+  def _release(self, length: int):
+    """Frees window bytes and wakes up commands waiting for them."""
+    self._in_flight -= length
+    while self._window_waiters:
+      _resolve(self._window_waiters.popleft())
+
+  def _parse(self, request: _Request) -> bool:
+    """Completes `request` if its response is buffered. Returns True if so."""
+    rx = self._rx
+    if not rx: return False
+    if rx[0] != request.command:
+      self._fail_all(AsyncSTLinkError(ERROR_DATA, 'Unexpected data: %02x' % rx[0], rx))
+      return False
+    if not request.acked:
+      request.acked = True
+      self._release(len(request.payload))
+    if len(rx) < 2: return False
+    if rx[1] == 0:
+      end = 2 + request.response_len
+      if len(rx) < end: return False
+      # READ and WRITE echo count and address, check that they match.
+      if request.command in (CMD_READ, CMD_WRITE) and rx[2:6] != request.payload[1:5]:
+        self._fail_all(AsyncSTLinkError(ERROR_DATA,
+          'Response for command 0x%02x (%s) does not match the request' % (
+            request.command, _name(request.command)), rx))
+        return False
+      _resolve(request.future, result=rx[2:end])
+    elif rx[1] == 0xFF:
+      end = 4
+      if len(rx) < end: return False
+      code = rx[2] << 8 | rx[3]
+      _resolve(request.future, exception=AsyncSTLinkError(ERROR_COMM,
+        'Command 0x%02x (%s) failed with code: 0x%02x' % (
+          request.command, _name(request.command), code), device_code=code))
+    else:
+      self._fail_all(AsyncSTLinkError(ERROR_DATA,
+        'Unexpected error code for command 0x%02x (%s): 0x%02x' % (
+          request.command, _name(request.command), rx[1]), rx))
+      return False
+    del rx[:end]
+    return True
+
+  def _fail_all(self, exception: Exception):
+    """Fails all requests in flight and drops any buffered data."""
+    while self._pending:
+      request = self._pending.popleft()
+      if not request.acked:
+        self._release(len(request.payload))
+      _resolve(request.future, exception=exception)
+    self._rx.clear()
+    self._tx.clear()
+
+class _SyncAccessGuard(object):
+  """
+  Stands in for the stlink of registers owned by AsyncFlash or AsyncDebugger.
+
+  Their registers only provide offsets and bit layouts; accessing them
+  synchronously would silently produce un-awaited coroutines.
+  """
+  def __init__(self, owner: str):
+    self.owner = owner
+
+  def __getattr__(self, name):
+    raise TypeError('{owner} registers cannot be accessed synchronously, '
+                    'use the async methods of {owner} instead'.format(owner=self.owner))
+
+async def _get_bit(stlink, register, bit_name: str) -> int:
+  bit = register.bits[bit_name]
+  return (await stlink.read(register.offset) & bit.mask) >> bit.start
+
+async def _set_bit(stlink, register, bit_name: str, value: int):
+  bit = register.bits[bit_name]
+  current = await stlink.read(register.offset)
+  await stlink.write(register.offset,
+    (current & ~bit.mask) | ((value << bit.start) & bit.mask))
+
+class AsyncFlash(Flash):
+  """`Flash` whose operations are issued through an `AsyncSTLink`."""
+  def __init__(self, stlink):
+    super().__init__(_SyncAccessGuard('AsyncFlash'))
+    self.stlink = stlink
+
+  async def unlock_option_bytes(self):
+    await _set_bit(self.stlink, self['FLASH_CR2'], 'OPT', 1)
+    await _set_bit(self.stlink, self['FLASH_NCR2'], 'OPT', 0)
+
+  async def unlock_data(self):
+    """unlocks the data area (eeprom, option bytes)"""
+    await self.stlink.write(self['FLASH_DUKR'].offset, 0xAE)
+    await self.stlink.write(self['FLASH_DUKR'].offset, 0x56)
+    assert await _get_bit(self.stlink, self['FLASH_IAPSR'], 'DUL'), 'not unlocked'
+
+  async def unlock_prog(self):
+    """unlocks the main program area"""
+    await self.stlink.write(self['FLASH_PUKR'].offset, 0x56)
+    await self.stlink.write(self['FLASH_PUKR'].offset, 0xAE)
+    assert await _get_bit(self.stlink, self['FLASH_IAPSR'], 'PUL'), 'not unlocked'
+
+  async def lock(self):
+    await _set_bit(self.stlink, self['FLASH_IAPSR'], 'DUL', 0)
+
+  async def wait_till_ready(self):
+    while await _get_bit(self.stlink, self['FLASH_IAPSR'], 'EOP'): pass
+
+  async def write(self, addr: int, block: bytes):
+    assert (addr & 0x3f) == 0, "addr must be on a 64 byte boundary"
+    assert len(block) == 64, "block must be exactly 64 bytes long"
+
+    vals = await self.stlink.read_bytes(self['FLASH_CR2'].offset, 2)
+    assert (vals[0] & 1) == 0, "FLASH_CR2.PRG bit is still set"
+    assert (vals[1] & 1) == 1, "FLASH_NCR2.PRG bit is still unset"
+    vals[0] |= 1
+    vals[1] -= 1
+    # Both writes are pipelined; the device processes them in order.
+    await asyncio.gather(
+      self.stlink.write_bytes(self['FLASH_CR2'].offset, vals),
+      self.stlink.write_bytes(addr, block))
+    iapsr = self['FLASH_IAPSR']
+    for i in range(320): # busy wait until programming finished
+      if await _get_bit(self.stlink, iapsr, 'EOP'): return
+    assert await _get_bit(self.stlink, iapsr, 'WR_PG_DIS') == 0, "flash failed, page is write-protected"
+    raise RuntimeError('Flash %s @%04x failed.' % (block, addr))
+
+class AsyncDebugger(Debugger):
+  """`Debugger` whose operations are issued through an `AsyncSTLink`."""
+  def __init__(self, stlink):
+    super().__init__(_SyncAccessGuard('AsyncDebugger'))
+    self.stlink = stlink
+
+  async def pause(self):
+    await _set_bit(self.stlink, self.DM_CSR2, 'STALL', 1)
+
+  async def cont(self):
+    await _set_bit(self.stlink, self.DM_CSR2, 'STALL', 0)
+
+  async def step(self):
+    """Returns true if the device was stopped due to the step instruction."""
+    await _set_bit(self.stlink, self.DM_CSR1, 'STE', 1)
+    await self.cont()
+    while await _get_bit(self.stlink, self.DM_CSR2, 'STALL') == 0:
+      pass
+    await _set_bit(self.stlink, self.DM_CSR1, 'STE', 0)
+    return await _get_bit(self.stlink, self.DM_CSR1, 'STF')
+
+  async def breakpoint(self, mode_str, bk1=0, bk2=0):
+    mode = BREAKPOINT_MODES[mode_str]
+    await _set_bit(self.stlink, self.DM_CR1, 'BC*',
+                   mode[0] << 4 | mode[1] << 3 | mode[2] << 2 | mode[3] << 1 | mode[4])
+    await self.stlink.write_w(self.DM_BKR1.offset, self.DM_BKR1.size, bk1)
+    await self.stlink.write_w(self.DM_BKR2.offset, self.DM_BKR2.size, bk2)
+
+  async def clear_breakpoint(self):
+    await self.breakpoint('Disabled', 0, 0)
+
+def _configure_tty(fd: int, speed: int):
+  _tty.setraw(fd)
+  attrs = termios.tcgetattr(fd)
+  attrs[2] |= termios.CREAD | termios.CLOCAL  # turn on READ & ignore ctrl lines
+  attrs[4] = attrs[5] = speed
+  termios.tcsetattr(fd, termios.TCSANOW, attrs)
+  termios.tcflush(fd, termios.TCIFLUSH)
+
+def _header(address: int, count: int) -> bytes:
+  return bytes([count, (address >> 16) & 0xff, (address >> 8) & 0xff, address & 0xff])
+
+def _name(command: int) -> str:
+  return COMMAND_NAMES.get(command, 'unknown (invalid)')
+
+def _resolve(future, result=None, exception=None):
+  if future.done(): return
+  if exception is not None:
+    future.set_exception(exception)
+  else:
+    future.set_result(result)
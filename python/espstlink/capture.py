@@ -0,0 +1,230 @@
+"""
+Record and replay of STLink traffic.
+
+`RecordingSTLink` logs every command sent through libespstlink together with
+its result and timing to a capture file. `ReplaySTLink` serves such a capture
+back without any hardware attached and raises `ReplayDivergence` as soon as
+the caller issues a command sequence that differs from the recording.
+
+A capture file starts with `MAGIC`, followed by one record per command:
+
+| Field       | Type   |                                                          |
+|-------------|--------|----------------------------------------------------------|
+| start       | uint64 | µs since the start of the capture                        |
+| duration    | uint32 | round-trip time in µs                                    |
+| error       | uint8  | 0 on success, otherwise the libespstlink error code      |
+| device_code | uint16 | the device error code of a failed command                |
+| req_len     | uint16 |                                                          |
+| resp_len    | uint16 |                                                          |
+| request     | bytes  | the command as sent on the wire (see serial-protocol.md) |
+| response    | bytes  | data returned to the caller, or the error data           |
+
+All integers are little-endian.
+"""
+import collections
+import struct
+import time
+import warnings
+
+from . import STLink, STLinkException
+from .protocol import (CMD_SOFT_RESET, CMD_READ, CMD_WRITE, CMD_RESET,
+                       CMD_SWIM_ENTRY, COMMAND_NAMES)
+
+MAGIC = b'ESPCAP\x02\x00'
+
+_HEADER = struct.Struct('<QIBHHH')
+
+Record = collections.namedtuple('Record', 'start duration error device_code request response')
+
+class ReplayDivergence(RuntimeError):
+  """The replayed tool issued a command that differs from the capture."""
+  def __init__(self, index: int, expected: Record, request: bytes):
+    self.index = index
+    self.expected = expected
+    self.request = request
+    super().__init__('Command #{index} diverges from capture: expected {expected}, got {actual}'.format(
+      index=index, expected=_describe(expected.request if expected else None),
+      actual=_describe(request)))
+
+class ReplayedError(STLinkException):
+  """An `STLinkException` served from a capture instead of libespstlink."""
+  def __init__(self, record: Record):
+    self.code = record.error
+    self.data = bytearray(record.response)
+    self.device_code = record.device_code
+    Exception.__init__(self, 'Device Error ({code}): replayed {command} failure (data={data})'.format(
+      code=self.code, command=_describe(record.request), data=self.data))
+
+class CaptureWriter(object):
+  """Appends records to a capture file through a buffered writer."""
+  def __init__(self, filename: str):
+    self.file = open(filename, 'wb')
+    self.file.write(MAGIC)
+    self.t0 = time.perf_counter()
+
+  def write(self, start: float, end: float, error: int, device_code: int,
+            request: bytes, response: bytes):
+    self.file.write(_HEADER.pack(int((start - self.t0) * 1e6), int((end - start) * 1e6),
+                                 error, device_code & 0xffff, len(request), len(response)))
+    self.file.write(request)
+    self.file.write(response)
+
+  def close(self):
+    self.file.close()
+
+def load(filename: str):
+  """
+  Load a capture file, yielding Record objects
+
+  A truncated record at the end (e.g. of a killed recording) is skipped with
+  a warning.
+  """
+  with open(filename, 'rb') as f:
+    data = f.read()
+  if not data.startswith(MAGIC):
+    raise ValueError('%s is not a capture file of this version' % filename)
+  offset = len(MAGIC)
+  while offset + _HEADER.size <= len(data):
+    start, duration, error, device_code, req_len, resp_len = _HEADER.unpack_from(data, offset)
+    end = offset + _HEADER.size + req_len + resp_len
+    if end > len(data):
+      break
+    offset += _HEADER.size
+    request = data[offset:offset + req_len]
+    response = data[offset + req_len:end]
+    offset = end
+    yield Record(start, duration, error, device_code, request, response)
+  if offset < len(data):
+    warnings.warn('%s: ignoring truncated record at offset %d' % (filename, offset))
+
+def _read_request(address: int, length: int) -> bytes:
+  return bytes([CMD_READ, length, (address >> 16) & 0xff, (address >> 8) & 0xff, address & 0xff])
+
+def _write_request(address: int, buf: bytes) -> bytes:
+  return bytes([CMD_WRITE, len(buf), (address >> 16) & 0xff, (address >> 8) & 0xff, address & 0xff]) + bytes(buf)
+
+def _reset_request(value, input) -> bytes:
+  return bytes([CMD_RESET, 0xFF if input else int(bool(value))])
+
+def _describe(request: bytes) -> str:
+  if not request: return 'end of capture'
+  return '{name}({args})'.format(name=COMMAND_NAMES.get(request[0], hex(request[0])),
+                                 args=request[1:6].hex())
+
+class RecordingSTLink(STLink):
+  """An `STLink` that writes all traffic to a `CaptureWriter`."""
+  def __init__(self, tty: bytes=b"/dev/ttyUSB0", *, capture: CaptureWriter):
+    self.pgm = None
+    self.capture = capture
+    super().__init__(tty)
+
+  def _record(self, request: bytes, call, *args):
+    start = time.perf_counter()
+    try:
+      result = call(*args)
+    except STLinkException as e:
+      self.capture.write(start, time.perf_counter(), e.code, e.device_code,
+                         request, bytes(e.data))
+      raise
+    response = result if isinstance(result, (bytes, bytearray)) else b''
+    self.capture.write(start, time.perf_counter(), 0, 0, request, response)
+    return result
+
+  def swim_entry(self):
+    return self._record(bytes([CMD_SWIM_ENTRY]), super().swim_entry)
+
+  def reset(self, value, input=False):
+    return self._record(_reset_request(value, input), super().reset, value, input)
+
+  def soft_reset(self):
+    return self._record(bytes([CMD_SOFT_RESET]), super().soft_reset)
+
+  def read_bytes(self, address: int, length: int) -> bytes:
+    return self._record(_read_request(address, length), super().read_bytes, address, length)
+
+  def write_bytes(self, address: int, buf: bytes) -> bool:
+    self._record(_write_request(address, buf), super().write_bytes, address, buf)
+    return True
+
+class ReplaySTLink(STLink):
+  """
+  An `STLink` that serves responses from a capture file.
+
+  If realtime=True, every response is delayed to match the recorded timing.
+  Otherwise the capture is replayed as fast as possible.
+  """
+  def __init__(self, tty: bytes=b"/dev/ttyUSB0", *, capture: str, realtime: bool=False):
+    self.pgm = None
+    self.records = list(load(capture))
+    self.index = 0
+    self.realtime = realtime
+    self.t0 = None
+
+  def remaining(self) -> int:
+    """Returns the number of recorded commands that were not replayed."""
+    return len(self.records) - self.index
+
+  def _replay(self, request: bytes) -> bytes:
+    record = self.records[self.index] if self.index < len(self.records) else None
+    if record is None or record.request != bytes(request):
+      raise ReplayDivergence(self.index, record, bytes(request))
+    self.index += 1
+    if self.realtime:
+      if self.t0 is None:
+        self.t0 = time.perf_counter() - record.start / 1e6
+      delay = self.t0 + (record.start + record.duration) / 1e6 - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+    if record.error:
+      raise ReplayedError(record)
+    return record.response
+
+  def swim_entry(self):
+    self._replay(bytes([CMD_SWIM_ENTRY]))
+
+  def reset(self, value, input=False):
+    self._replay(_reset_request(value, input))
+
+  def soft_reset(self):
+    self._replay(bytes([CMD_SOFT_RESET]))
+
+  def read_bytes(self, address: int, length: int) -> bytes:
+    assert length < 255
+    return bytearray(self._replay(_read_request(address, length)))
+
+  def write_bytes(self, address: int, buf: bytes) -> bool:
+    assert len(buf) < 255
+    self._replay(_write_request(address, buf))
+    return True
+
+Stats = collections.namedtuple('Stats', 'count round_trip bytes')
+
+def summarize(records) -> dict:
+  """Returns Stats (count, total round-trip µs, wire bytes) per command name."""
+  stats = collections.defaultdict(lambda: Stats(0, 0, 0))
+  for r in records:
+    name = COMMAND_NAMES.get(r.request[0], hex(r.request[0]))
+    s = stats[name]
+    stats[name] = Stats(s.count + 1, s.round_trip + r.duration,
+                        s.bytes + len(r.request) + len(r.response))
+  return dict(stats)
+
+def compare(a, b) -> str:
+  """Renders command-count and round-trip deltas between two captures."""
+  sa, sb = summarize(a), summarize(b)
+  lines = ['{:<12} {:>8} {:>8} {:>8} {:>12} {:>12} {:>12}'.format(
+    'command', 'count A', 'count B', 'delta', 'rtt A (ms)', 'rtt B (ms)', 'delta (ms)')]
+  zero = Stats(0, 0, 0)
+  total_a, total_b = zero, zero
+  for name in sorted(set(sa) | set(sb)):
+    x, y = sa.get(name, zero), sb.get(name, zero)
+    total_a = Stats(*[i + j for i, j in zip(total_a, x)])
+    total_b = Stats(*[i + j for i, j in zip(total_b, y)])
+    lines.append(_compare_line(name, x, y))
+  lines.append(_compare_line('total', total_a, total_b))
+  return '\n'.join(lines)
+
+def _compare_line(name: str, x: Stats, y: Stats) -> str:
+  return '{:<12} {:>8} {:>8} {:>+8} {:>12.1f} {:>12.1f} {:>+12.1f}'.format(
+    name, x.count, y.count, y.count - x.count,
+    x.round_trip / 1e3, y.round_trip / 1e3, (y.round_trip - x.round_trip) / 1e3)
@@ -0,0 +1,24 @@
+"""Constants of the esp-stlink serial protocol (see serial-protocol.md)."""
+
+CMD_SOFT_RESET = 0x00
+CMD_READ = 0x01
+CMD_WRITE = 0x02
+CMD_RESET = 0xFD
+CMD_SWIM_ENTRY = 0xFE
+CMD_GET_VERSION = 0xFF
+
+COMMAND_NAMES = {
+  CMD_SOFT_RESET: 'SOFT_RESET',
+  CMD_READ: 'READ',
+  CMD_WRITE: 'WRITE',
+  CMD_RESET: 'HARD_RESET',
+  CMD_SWIM_ENTRY: 'SWIM_ENTRY',
+  CMD_GET_VERSION: 'GET_VERSION',
+}
+
+# Error codes, same as ESPSTLINK_ERROR_* in libespstlink.h.
+ERROR_READ = 1
+ERROR_DATA = 2
+ERROR_COMM = 3
+ERROR_VERSION = 4
+ERROR_SERIAL = 5
@@ -2,7 +2,7 @@
 import espstlink
 import sys
 from espstlink.debugger import Debugger, CPU
-import string
+from tracefile import TraceWriter, format_state
 
 class BufferedStlink(espstlink.STLink):
   def __init__(self, stlink):
@@ -21,44 +21,65 @@ class BufferedStlink(espstlink.STLink):
     #print(self.buf)
     
 
-def h(val, size):
-  """static-sized hex"""
-  return hex(val | (1 << (size * 8)))[3:]
-
-printable = ''.join(set(string.printable) - set(string.whitespace))
-
-def reg(s, name, size):
-  """string representation of a register"""
-  return f"{name}={h(s[name], size)} {s[name]} {chr(s[name]) if chr(s[name]) in printable else '.'}"
-
 class CpuState(dict):
-  def __init__(self, cpu):
+  def __init__(self, cpu, stack_size=8):
     super(CpuState, self).__init__()
     data = cpu.stlink.buffer(0x7F00, 11)
     for k in ['PC', 'X', 'Y', 'A', 'SP', 'CC']:
       self[k] = cpu[k].value
-    self['stack'] = cpu.stlink.stlink.read_bytes(self['SP'], 8)
+    self['stack'] = b''
+    if stack_size:
+      self['stack'] = cpu.stlink.stlink.read_bytes(self['SP'], stack_size)
 
   def __str__(self):
-    s = self
-    return f"{h(s['PC'], 3)}: {reg(s, 'X', 2)} {reg(s, 'Y', 2)} {reg(s, 'A', 2)} SP={h(s['SP'], 2)} CC={bin(s['CC'])[2:]}"
+    return format_state(self)
+
+def trace(dev, writer=None, steps=None):
+  """
+  Single-steps the CPU, printing its state after each instruction.
 
-def trace(dev):
+  If a TraceWriter is given, states are written to it instead. The stack
+  window is only read from the device if the writer records it.
+  """
   deb = Debugger(dev)
   buf = BufferedStlink(dev)
   cpu = CPU(buf)
+  stack_size = writer.stack_size if writer else 0
   
-  while True:
-    s = CpuState(cpu)
-    print(str(s))
+  step = 0
+  while steps is None or step < steps:
+    s = CpuState(cpu, stack_size)
+    if writer:
+      writer.write(s)
+    else:
+      print(str(s))
     deb.step()
+    step += 1
 
 if __name__ == '__main__':
   import argparse
   parser = argparse.ArgumentParser()
   parser.add_argument("-d", "--device", default='/dev/ttyUSB0',
                     help="The serial device the HC is connected to")
+  parser.add_argument("-n", "--steps", type=int,
+                    help="Stop after this many instructions")
+  parser.add_argument("-o", "--output",
+                    help="Write a binary trace to this file (see traceanalyze.py)")
+  parser.add_argument("--delta", action='store_true',
+                    help="Delta-encode binary trace records (implies --compress)")
+  parser.add_argument("-z", "--compress", action='store_true',
+                    help="zlib-compress the binary trace")
+  parser.add_argument("--no-stack", action='store_true',
+                    help="Don't include the stack window in binary trace records")
   args = parser.parse_args()
   dev = espstlink.STLink(args.device.encode())
   dev.init(reset=False)
-  trace(dev)
+  writer = None
+  if args.output:
+    writer = TraceWriter(args.output, stack_size=0 if args.no_stack else 8,
+                         delta=args.delta, compress=args.compress)
+  try:
+    trace(dev, writer, args.steps)
+  finally:
+    if writer:
+      writer.close()
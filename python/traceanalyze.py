@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Offline analysis of binary traces written by `swimtrace.py -o`.
+
+  ./traceanalyze.py trace.bin hist        most frequently executed addresses
+  ./traceanalyze.py trace.bin loops       backward jumps and their iteration counts
+  ./traceanalyze.py trace.bin calls       call/return reconstruction from SP changes
+  ./traceanalyze.py trace.bin show 100 200  text view of records 100..199
+"""
+import collections
+
+from tracefile import TraceFile, format_state, h
+
+# The longest STM8 instruction (including prefix) is 5 bytes long.
+MAX_INSTRUCTION_LENGTH = 5
+# Bytes pushed by CALL, CALLF and on interrupt entry.
+CALL_FRAMES = {2: 'CALL', 3: 'CALLF', 9: 'INT'}
+
+Frame = collections.namedtuple('Frame', 'step caller target sp kind')
+
+def _sp_delta(prev, cur) -> int:
+  delta = (cur.SP - prev.SP) & 0xffff
+  return delta - 0x10000 if delta & 0x8000 else delta
+
+def _is_sequential(prev, cur) -> bool:
+  return prev.PC < cur.PC <= prev.PC + MAX_INSTRUCTION_LENGTH
+
+def _pairs(trace):
+  it = iter(trace)
+  prev = next(it, None)
+  for step, cur in enumerate(it, 1):
+    yield step, prev, cur
+    prev = cur
+
+def histogram(trace) -> collections.Counter:
+  """Counts how often each instruction address was executed."""
+  return collections.Counter(s.PC for s in trace)
+
+def loops(trace) -> collections.Counter:
+  """Counts backward jumps (loop back-edges) as (from, to) address pairs."""
+  edges = collections.Counter()
+  for step, prev, cur in _pairs(trace):
+    if cur.PC <= prev.PC and _sp_delta(prev, cur) == 0:
+      edges[prev.PC, cur.PC] += 1
+  return edges
+
+def _return_address(s, size: int):
+  """Reads the return address just pushed onto the stack, if recorded."""
+  if len(s.stack) < size + 1: return None
+  value = 0
+  for i in s.stack[1:size + 1]:
+    value = value << 8 | i
+  return value
+
+def calls(trace):
+  """
+  Reconstructs calls and returns from SP changes at non-sequential PC changes.
+
+  Yields ('call', Frame, depth) and ('ret', Frame, step, depth) events. Where
+  the trace contains a stack window, the pushed return address is checked to
+  tell calls apart from pushes that happen to precede a jump.
+  """
+  stack = []
+  for step, prev, cur in _pairs(trace):
+    if _is_sequential(prev, cur): continue
+    delta = _sp_delta(prev, cur)
+    if -delta in CALL_FRAMES:
+      kind = CALL_FRAMES[-delta]
+      if kind != 'INT':
+        ret = _return_address(cur, -delta)
+        if ret is not None and not prev.PC < ret <= prev.PC + MAX_INSTRUCTION_LENGTH:
+          continue
+      frame = Frame(step - 1, prev.PC, cur.PC, prev.SP, kind)
+      stack.append(frame)
+      yield 'call', frame, len(stack)
+    elif delta in CALL_FRAMES:
+      # unwind to the frame whose SP is restored by this return
+      while stack and stack[-1].sp != cur.SP and ((stack[-1].sp - cur.SP) & 0x8000):
+        stack.pop()
+      if stack and stack[-1].sp == cur.SP:
+        yield 'ret', stack.pop(), step, len(stack)
+
+def call_summary(trace) -> dict:
+  """Returns {target: [calls, inclusive steps]} for all reconstructed calls."""
+  summary = collections.defaultdict(lambda: [0, 0])
+  for event in calls(trace):
+    if event[0] == 'ret':
+      frame, step = event[1], event[2]
+      summary[frame.target][0] += 1
+      summary[frame.target][1] += step - frame.step
+  return dict(summary)
+
+if __name__ == '__main__':
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument("trace", help="A binary trace written by swimtrace.py -o")
+  sub = parser.add_subparsers(dest='command', required=True)
+  hist = sub.add_parser('hist', help="Instruction address histogram")
+  hist.add_argument("-t", "--top", type=int, default=20)
+  loop = sub.add_parser('loops', help="Detected loops")
+  loop.add_argument("-t", "--top", type=int, default=20)
+  call = sub.add_parser('calls', help="Reconstructed calls")
+  call.add_argument("--tree", action='store_true', help="Print every call and return")
+  show = sub.add_parser('show', help="Text view of a range of records")
+  show.add_argument("start", type=int)
+  show.add_argument("end", type=int, nargs='?')
+  args = parser.parse_args()
+
+  trace = TraceFile(args.trace)
+  if args.command == 'hist':
+    total = len(trace)
+    for pc, count in histogram(trace).most_common(args.top):
+      print('%s %10d %6.2f%%' % (h(pc, 3), count, 100. * count / total))
+  elif args.command == 'loops':
+    for (src, dst), count in loops(trace).most_common(args.top):
+      print('%s -> %s %10d iterations' % (h(src, 3), h(dst, 3), count))
+  elif args.command == 'calls':
+    if args.tree:
+      for event in calls(trace):
+        if event[0] == 'call':
+          frame, depth = event[1], event[2]
+          print('%10d %s%s %s -> %s' % (frame.step, '  ' * (depth - 1), frame.kind,
+                                        h(frame.caller, 3), h(frame.target, 3)))
+        else:
+          frame, step, depth = event[1:]
+          print('%10d %sret %s (%d steps)' % (step, '  ' * depth,
+                                               h(frame.target, 3), step - frame.step))
+    else:
+      for target, (count, steps) in sorted(call_summary(trace).items(),
+                                            key=lambda x: -x[1][1]):
+        print('%s %8d calls %10d steps' % (h(target, 3), count, steps))
+  else:
+    end = args.end if args.end is not None else args.start + 1
+    for i, s in enumerate(trace.range(args.start, end), args.start):
+      print('%10d %s %s' % (i, format_state(s._asdict()), s.stack.hex()))
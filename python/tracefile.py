@@ -0,0 +1,162 @@
+"""
+Binary trace format for swimtrace.
+
+A trace file starts with an 8 byte header (magic, version, flags, stack size)
+followed by fixed-size little-endian records:
+
+| Field | Type      |                                   |
+|-------|-----------|-----------------------------------|
+| PC    | uint32    |                                   |
+| A     | uint8     |                                   |
+| X     | uint16    |                                   |
+| Y     | uint16    |                                   |
+| SP    | uint16    |                                   |
+| CC    | uint8     |                                   |
+| stack | bytes     | `stack size` bytes starting at SP |
+
+With FLAG_DELTA each record is XORed with its predecessor, except for every
+KEYFRAME_INTERVAL-th record which is stored as is, so that any record can be
+decoded without reading the whole file. Delta encoding by itself doesn't
+change the file size, it only makes the records compress better, so it is
+always combined with FLAG_ZLIB. With FLAG_ZLIB the records are
+zlib-compressed; such files are decompressed into memory on load, all others
+are memory-mapped.
+"""
+import collections
+import mmap
+import string
+import struct
+import zlib
+
+MAGIC = b'SWTR'
+VERSION = 1
+FLAG_DELTA = 1
+FLAG_ZLIB = 2
+KEYFRAME_INTERVAL = 4096
+
+_HEADER = struct.Struct('<4sBBBx')
+
+State = collections.namedtuple('State', 'PC A X Y SP CC stack')
+
+def h(val, size):
+  """static-sized hex"""
+  return hex(val | (1 << (size * 8)))[3:]
+
+printable = ''.join(set(string.printable) - set(string.whitespace))
+
+def reg(s, name, size):
+  """string representation of a register"""
+  return f"{name}={h(s[name], size)} {s[name]} {chr(s[name]) if chr(s[name]) in printable else '.'}"
+
+def format_state(s) -> str:
+  """Formats a mapping with PC, X, Y, A, SP and CC entries as one trace line."""
+  return f"{h(s['PC'], 3)}: {reg(s, 'X', 2)} {reg(s, 'Y', 2)} {reg(s, 'A', 2)} SP={h(s['SP'], 2)} CC={bin(s['CC'])[2:]}"
+
+def _record_struct(stack_size: int) -> struct.Struct:
+  return struct.Struct('<IBHHHB%ds' % stack_size)
+
+class TraceWriter(object):
+  """
+  Writes trace records through a buffered (and optionally compressing) writer.
+
+  delta=True implies compress=True.
+  """
+  def __init__(self, filename: str, stack_size: int=8, delta: bool=False,
+               compress: bool=False):
+    compress = compress or delta
+    self.file = open(filename, 'wb', buffering=1 << 20)
+    flags = (FLAG_DELTA if delta else 0) | (FLAG_ZLIB if compress else 0)
+    self.file.write(_HEADER.pack(MAGIC, VERSION, flags, stack_size))
+    self.record = _record_struct(stack_size)
+    self.stack_size = stack_size
+    self.delta = delta
+    self.compressor = zlib.compressobj() if compress else None
+    self.count = 0
+    self.prev = 0
+
+  def write(self, s):
+    """Appends a mapping with PC, A, X, Y, SP, CC and stack entries."""
+    stack = bytes(s.get('stack', b''))[:self.stack_size].ljust(self.stack_size, b'\0')
+    data = self.record.pack(s['PC'], s['A'], s['X'], s['Y'], s['SP'], s['CC'], stack)
+    if self.delta:
+      value = int.from_bytes(data, 'little')
+      if self.count % KEYFRAME_INTERVAL:
+        data = (value ^ self.prev).to_bytes(self.record.size, 'little')
+      self.prev = value
+    if self.compressor:
+      data = self.compressor.compress(data)
+    self.file.write(data)
+    self.count += 1
+
+  def close(self):
+    if self.compressor:
+      self.file.write(self.compressor.flush())
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class TraceFile(object):
+  """Random and sequential access to the records of a trace file."""
+  def __init__(self, filename: str):
+    with open(filename, 'rb') as f:
+      magic, version, self.flags, self.stack_size = _HEADER.unpack(f.read(_HEADER.size))
+      if magic != MAGIC:
+        raise ValueError('%s is not a trace file' % filename)
+      if version != VERSION:
+        raise ValueError('%s: unsupported trace version %d' % (filename, version))
+      if self.flags & FLAG_ZLIB:
+        # decompressobj also recovers the complete records of a trace whose
+        # writer was never closed.
+        self.data = memoryview(zlib.decompressobj().decompress(f.read()))
+      else:
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = memoryview(self.map)[_HEADER.size:]
+    self.record = _record_struct(self.stack_size)
+    self.delta = bool(self.flags & FLAG_DELTA)
+
+  def __len__(self):
+    return len(self.data) // self.record.size
+
+  def _raw(self, index: int) -> int:
+    size = self.record.size
+    return int.from_bytes(self.data[index * size:(index + 1) * size], 'little')
+
+  def _decode(self, value: int) -> State:
+    return State(*self.record.unpack(value.to_bytes(self.record.size, 'little')))
+
+  def __getitem__(self, index: int) -> State:
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError(index)
+    if not self.delta:
+      return State(*self.record.unpack_from(self.data, index * self.record.size))
+    value = 0
+    for i in range(index - index % KEYFRAME_INTERVAL, index + 1):
+      value ^= self._raw(i)
+    return self._decode(value)
+
+  def __iter__(self):
+    return self.range(0, len(self))
+
+  def range(self, start: int, end: int):
+    """Yields the States of records start..end-1."""
+    end = min(end, len(self))
+    if start >= end:
+      return
+    if not self.delta:
+      size = self.record.size
+      for values in self.record.iter_unpack(self.data[start * size:end * size]):
+        yield State(*values)
+      return
+    value = self[start]
+    value = int.from_bytes(self.record.pack(*value), 'little')
+    yield self._decode(value)
+    for i in range(start + 1, end):
+      raw = self._raw(i)
+      value = raw if i % KEYFRAME_INTERVAL == 0 else value ^ raw
+      yield self._decode(value)